@@ -0,0 +1,132 @@
+"""
+Compare building an account hierarchy with the Account/ChildAccount
+constructors against building the same hierarchy with Account.from_tree.
+
+Builds ROOTS root accounts, each with FAN_OUT children that each have
+FAN_OUT children of their own (ROOTS * (1 + FAN_OUT + FAN_OUT ** 2)
+accounts, 222,000 by default) with one market segment per root account.
+Each way of building is timed and then built again under tracemalloc to
+measure the memory still allocated afterwards and the peak, every run in
+a fresh python process so one doesn't affect the other. The nested
+description from_tree is given is built before the measurements start,
+its own time and size are reported on a separate line.
+
+usage: python bench_from_tree.py [constructors|from_tree]
+       (runs both when no argument is given, e.g.
+        python bench_from_tree.py > bench_output.txt)
+"""
+
+import gc
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import python_coding_test as pct
+
+ROOTS = 2000
+FAN_OUT = 10
+
+
+def make_segments():
+    """
+    the market segments, one per root account. Creating a MarketSegment
+    looks through the module globals, so this is kept out of the timings
+    :return: List[MarketSegment]
+    """
+    return [pct.MarketSegment("bench segment {}".format(i))
+            for i in range(ROOTS)]
+
+
+def no_description(segments):
+    """
+    the constructors don't need a description
+    :param segments: List[MarketSegment]
+    :return: List[MarketSegment]
+    """
+    return segments
+
+
+def build_with_constructors(segments):
+    """
+    build the hierarchy one constructor call at a time
+    :param segments: List[MarketSegment]
+    :return: List[Account]
+    """
+    roots = []
+    for i in range(ROOTS):
+        root = pct.Account("r{}".format(i), "Bench Rep", [segments[i]])
+        for j in range(FAN_OUT):
+            child = pct.ChildAccount("r{}-{}".format(i, j), root)
+            for k in range(FAN_OUT):
+                pct.ChildAccount("r{}-{}-{}".format(i, j, k), child)
+        roots.append(root)
+    return roots
+
+
+def make_description(segments):
+    """
+    the nested description of the hierarchy for from_tree
+    :param segments: List[MarketSegment]
+    :return: List[dict]
+    """
+    return [{"name": "r{}".format(i),
+             "sales_rep": "Bench Rep",
+             "market_segments": [segments[i]],
+             "children": [{"name": "r{}-{}".format(i, j),
+                           "children": [{"name": "r{}-{}-{}".format(i, j, k)}
+                                        for k in range(FAN_OUT)]}
+                          for j in range(FAN_OUT)]}
+            for i in range(ROOTS)]
+
+
+# how to prepare the input and then build the hierarchy from it
+BUILDERS = {"constructors": (no_description, build_with_constructors),
+            "from_tree": (make_description, pct.Account.from_tree)}
+
+
+def measure(name):
+    """
+    time one way of building the hierarchy, then build it again under
+    tracemalloc and print the results
+    :param name: string, a key of BUILDERS
+    :return: None
+    """
+    prepare, build = BUILDERS[name]
+
+    segments = make_segments()
+    start = time.perf_counter()
+    source = prepare(segments)
+    prepare_elapsed = time.perf_counter() - start
+    gc.collect()
+    start = time.perf_counter()
+    build(source)
+    elapsed = time.perf_counter() - start
+    del source
+
+    # building the description only ever adds memory, so its peak is the
+    # memory it ends up using and doesn't hide the peak of the build
+    segments = make_segments()
+    gc.collect()
+    tracemalloc.start()
+    source = prepare(segments)
+    prepared = tracemalloc.get_traced_memory()[0]
+    build(source)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print("{name:>12}: {elapsed:.2f}s, {current:.1f}MB allocated, "
+          "{peak:.1f}MB peak".format(name=name, elapsed=elapsed,
+                                     current=(current - prepared) / 1e6,
+                                     peak=(peak - prepared) / 1e6))
+    if prepare is not no_description:
+        print("{:>12}  description: {:.2f}s, {:.1f}MB".format(
+            "", prepare_elapsed, prepared / 1e6))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        measure(sys.argv[1])
+    else:
+        for builder in BUILDERS:
+            subprocess.check_call([sys.executable, __file__, builder])
@@ -23,21 +23,48 @@ Your final submissions should:
 """
 
 import copy
+import hashlib
+import heapq
+import itertools
+import json
 import re
+import weakref
+from collections import deque, namedtuple
 
 
 class SalesRep(object):
     """
     Models a sales representative. Sales representatives know
-    their own names and which accounts are assigned to them.
+    their own names and which accounts are assigned to them. A SalesRep
+    may also specialize in a set of MarketSegments and have a capacity
+    limiting how many accounts the rebalancing engine will give them.
     """
-    def __init__(self, first_name, last_name, accounts=None):
+    def __init__(self, first_name, last_name, accounts=None,
+                 market_segments=None, capacity=None):
+        """
+        setup this instance of SalesRep
+        :param first_name: string
+        :param last_name: string
+        :param accounts: List[Account]
+        :param market_segments: List[MarketSegment] the segments this rep
+                                specializes in, None means the rep is a
+                                generalist
+        :param capacity: int, the maximum number of accounts the rep can be
+                         assigned by rebalance_accounts, None is unlimited
+        """
         self.first_name = first_name
         self.last_name = last_name
         self._accounts = []
+        self._market_segments = []
+        self.capacity = capacity
+        # how many accounts assigned to this rep are in each MarketSegment,
+        # kept up to date by the MarketSegments themselves
+        self._segment_counts = {}
 
         if accounts:
             self._accounts.extend(accounts)
+        if market_segments:
+            self._market_segments.extend(market_segments)
 
     def __str__(self):
         return "{self.first_name} {self.last_name}".format(self=self)
@@ -53,6 +80,30 @@ class SalesRep(object):
         self._accounts.remove(account)
         account.set_sales_rep(None)
 
+    def get_market_segments(self):
+        """
+        get the market segments this rep specializes in
+        :return: List[MarketSegment]
+        """
+        return self._market_segments
+
+    def get_segment_counts(self):
+        """
+        get how many of the accounts assigned to this rep are in each
+        market segment, without going through the accounts
+        :return: Dict[MarketSegment, int]
+        """
+        return dict(self._segment_counts)
+
+    def _count_segment(self, market_segment, delta):
+        """
+        update the number of this rep's accounts in market_segment
+        :param market_segment: MarketSegment
+        :param delta: int, 1 when an account joins, -1 when it leaves
+        :return: None
+        """
+        _update_count(self._segment_counts, market_segment, delta)
+
 
 # +---------------------------------------------------------------------------+
 # |                                                                           |
@@ -94,10 +145,15 @@ class MarketSegment(object):
         :param name: string
         :param accounts: List[Account]
         """
-        self.name = name
+        self._name = name
+        # rollup counters: accounts per sales rep and how many accounts are
+        # ChildAccounts, the account count is just the length of _accounts
+        self._rep_counts = {}
+        self._child_count = 0
         if accounts:
             self._accounts = accounts
             for account in accounts:
+                self._count(account, 1)
                 # add_account_to_ms is False because we've already added the
                 # account to this segment, don't want to do it again
                 account.add_to_market_segment(self, add_account_to_ms=False)
@@ -111,6 +167,21 @@ class MarketSegment(object):
     def __repr__(self):
         return "{self.name}: {self._accounts}".format(self=self)
 
+    @property
+    def name(self):
+        return self._name
+
+    @name.setter
+    def name(self, name):
+        """
+        renaming a segment changes the content hash of every account in it
+        :param name: string
+        :return: None
+        """
+        self._name = name
+        for account in self._accounts:
+            account._invalidate_hash()
+
     def add_account(self, account, add_ms_to_account=True):
         """
         provide functionality to associate an account with the market segment
@@ -134,6 +205,7 @@ class MarketSegment(object):
             raise ValueError("{} already associated to {}".format(account.name,
                                                                   self.name))
         self._accounts.append(account)
+        self._count(account, 1)
         if add_ms_to_account:
             # add_account_to_ms is False because we've already added the
             # account to this segment, don't want to do it again
@@ -152,6 +224,7 @@ class MarketSegment(object):
         # check for accounts by name per Q2 bonus below
         if account.name in [account.name for account in self._accounts]:
             self._accounts.remove(account)
+            self._count(account, -1)
             if remove_ms_from_account:
                 account.remove_from_market_segment(self)
         else:
@@ -166,12 +239,58 @@ class MarketSegment(object):
         """
         return self._accounts
 
+    def get_rollup(self):
+        """
+        get the overview numbers for this segment without going through
+        its accounts: the number of accounts, the number of distinct sales
+        reps and how many of the accounts are root and child accounts
+        :return: dict
+        """
+        return {"accounts": len(self._accounts),
+                "sales_reps": len(self._rep_counts),
+                "root_accounts": len(self._accounts) - self._child_count,
+                "child_accounts": self._child_count}
+
+    def _count(self, account, delta):
+        """
+        update the rollup counters when account joins or leaves this segment
+        :param account: Account
+        :param delta: int, 1 when the account joins, -1 when it leaves
+        :return: None
+        """
+        if account._is_child:
+            self._child_count += delta
+        self._count_rep(account.get_sales_rep(), delta)
+
+    def _count_rep(self, sales_rep, delta):
+        """
+        update the number of accounts in this segment assigned to sales_rep
+        :param sales_rep: SalesRep
+        :param delta: int, 1 when an account joins, -1 when it leaves
+        :return: None
+        """
+        if sales_rep is None:
+            return
+        _update_count(self._rep_counts, sales_rep, delta)
+        # plain rep names (strings) can't keep counts of their own
+        if isinstance(sales_rep, SalesRep):
+            sales_rep._count_segment(self, delta)
+
 
 class Account(object):
     """
     Models an account. Accounts know their name, the sales rep they're
     assigned to, and the market segments they're a part of.
     """
+    # a weak reference to the parent (see get_parent) and whether this is
+    # a child account. Both are set before Account.__init__ runs so the
+    # market segments can count the account as a child account. The flag
+    # doesn't depend on the weak reference, so an account whose parent has
+    # been garbage collected is still counted as a child until it's
+    # detached
+    _parent_ref = None
+    _is_child = False
+
     def __init__(self, name, sales_rep=None, market_segments=None):
         """
         setup this instance of Account
@@ -179,9 +298,14 @@ class Account(object):
         :param sales_rep: SalesRep
         :param market_segments: List[MarketSegment]
         """
+        # the content hash is worked out lazily by get_content_hash
+        self._hash = None
         self.name = name
         self._sales_rep = sales_rep
-        self._children = []
+        # children keyed by id so they can be detached in O(1), dicts keep
+        # their insertion order so the children stay in the order they were
+        # added
+        self._children = {}
         if market_segments:
             self._market_segments = market_segments
             for market_segment in market_segments:
@@ -194,6 +318,15 @@ class Account(object):
     def __str__(self):
         return "{self.name}".format(self=self)
 
+    @property
+    def name(self):
+        return self._name
+
+    @name.setter
+    def name(self, name):
+        self._name = name
+        self._invalidate_hash()
+
     def get_sales_rep(self):
         """
         get the sales rep assocated to this Account
@@ -207,7 +340,13 @@ class Account(object):
         :param sales_rep: SalesRep
         :return: None
         """
+        old_rep = self._sales_rep
         self._sales_rep = sales_rep
+        if old_rep is not sales_rep:
+            for market_segment in self._market_segments:
+                market_segment._count_rep(old_rep, -1)
+                market_segment._count_rep(sales_rep, 1)
+        self._invalidate_hash()
 
     def set_market_segments(self, segments):
         """
@@ -222,7 +361,9 @@ class Account(object):
               MarketSegment's internal representation of associated Accounts
               appropriately.
         """
-        for existing_segment in self._market_segments:
+        # iterate over a copy, removing the account from a segment also
+        # removes the segment from self._market_segments
+        for existing_segment in list(self._market_segments):
             # only need to remove the ones that aren't in the new list
             if existing_segment not in segments:
                 existing_segment.remove_account(self)
@@ -230,6 +371,8 @@ class Account(object):
             # add segments, catch ValueErrors which means the segment was
             # already part of this account, therefor no followup action is
             # needed
+            if segment in self._market_segments:
+                continue
             try:
                 self._market_segments.append(segment)
                 # add_ms_to_account needs to be False because we've already
@@ -239,6 +382,7 @@ class Account(object):
                 # this account was already associated to that segment,
                 # continue on
                 continue
+        self._invalidate_hash()
 
     def add_to_market_segment(self, market_segment, add_account_to_ms=True):
         """
@@ -255,6 +399,7 @@ class Account(object):
                              .format(name=self.name,
                                      ms_name=market_segment.name))
         self._market_segments.append(market_segment)
+        self._invalidate_hash()
         if add_account_to_ms:
             # add_ms_to_account needs to be False since this account already
             # knows about the market segment
@@ -268,6 +413,7 @@ class Account(object):
         """
         if market_segment in self._market_segments:
             self._market_segments.remove(market_segment)
+            self._invalidate_hash()
             market_segment.remove_account(self)
         else:
             # nothing to do, the market segment was already
@@ -287,14 +433,341 @@ class Account(object):
         :param child_account: ChildAccount
         :return:
         """
-        self._children.append(child_account)
+        self._children[id(child_account)] = child_account
+        self._invalidate_hash()
 
     def get_children(self):
         """
-        get the list of children (if any) for this account
+        get the list of children (if any) for this account, in the order
+        they were added. The list is a copy, use add_child, detach and
+        reparent to change the children.
         :return: List[ChildAccount]
         """
-        return self._children
+        # the traversals in this module go through _children.values()
+        # directly so they don't copy every account's children
+        return list(self._children.values())
+
+    def get_content_hash(self):
+        """
+        get a hash of this account's name, sales rep, market segment names
+        and the content hashes of its children, so two accounts with the
+        same hash have identical subtrees. Hashes are cached and any change
+        to an account clears the cached hash of the account and of every
+        ancestor, so only the changed path gets hashed again.
+        Note that renaming a SalesRep doesn't clear the cache.
+        :return: bytes
+        """
+        if self._hash is not None:
+            return self._hash
+
+        # post-order walk without recursion, children are always hashed
+        # before their parent. A cached hash means the whole subtree under
+        # that account is cached too (see _invalidate_hash)
+        stack = [(self, False)]
+        while stack:
+            account, children_done = stack.pop()
+            if account._hash is not None:
+                continue
+            if not children_done:
+                stack.append((account, True))
+                stack.extend((child, False)
+                             for child in account._children.values()
+                             if child._hash is None)
+                continue
+
+            sales_rep = account.get_sales_rep()
+            content = hashlib.blake2b(digest_size=16)
+            content.update(json.dumps(
+                [account.name,
+                 None if sales_rep is None else str(sales_rep),
+                 sorted(segment.name
+                        for segment in account.get_market_segments())]
+            ).encode("utf-8"))
+            for child in account._children.values():
+                content.update(child._hash)
+            account._hash = content.digest()
+        return self._hash
+
+    def _invalidate_hash(self):
+        """
+        clear the cached content hash of this account and its ancestors.
+        Stops at the first ancestor that's already cleared, since its own
+        ancestors were cleared at the same time.
+        :return: None
+        """
+        account = self
+        while account is not None and account._hash is not None:
+            account._hash = None
+            account = account.get_parent()
+
+    def get_parent(self):
+        """
+        get the parent of this account. Accounts only keep a weak reference
+        to their parent (the parent keeps its children alive, not the other
+        way around), so this is None for root accounts and for accounts
+        whose parent no longer exists. Those accounts are still counted as
+        child accounts by their market segments until they're detached.
+        :return: Account/ChildAccount
+        """
+        if self._parent_ref is None:
+            return None
+        return self._parent_ref()
+
+    def detach(self):
+        """
+        remove this account (and everything under it) from its parent, the
+        account becomes a root account but keeps its own sales rep and
+        market segments. Doesn't depend on the size of the hierarchy, only
+        the parent's ancestors have their content hash cleared.
+        :return: None
+        """
+        if not self._is_child:
+            return
+        # the parent may have been garbage collected already
+        parent = self.get_parent()
+        if parent is not None:
+            del parent._children[id(self)]
+            parent._invalidate_hash()
+        self._parent_ref = None
+        self._is_child = False
+        self._count_as_child(-1)
+
+    def reparent(self, new_parent):
+        """
+        move this account (and everything under it) so it becomes a child
+        of new_parent. The account keeps its own sales rep and market
+        segments rather than inheriting the new parent's.
+        Raises ValueError if new_parent is this account or one of its
+        descendants, since that would turn the hierarchy into a loop.
+        :param new_parent: Account/ChildAccount
+        :return: None
+        """
+        ancestor = new_parent
+        while ancestor is not None:
+            if ancestor is self:
+                raise ValueError("{} can't be moved under {}, it's part of "
+                                 "its own hierarchy"
+                                 .format(self.name, new_parent.name))
+            ancestor = ancestor.get_parent()
+
+        self.detach()
+        self._parent_ref = weakref.ref(new_parent)
+        self._is_child = True
+        self._count_as_child(1)
+        new_parent.add_child(self)
+
+    def delete_subtree(self):
+        """
+        retire this account and everything under it. The accounts are
+        detached from the hierarchy and unlinked from their market segments
+        and sales reps so nothing keeps them alive. Every market segment and
+        sales rep that loses accounts has its account list filtered once,
+        instead of removing the accounts one at a time, so this is a single
+        linear pass over the subtree.
+        :return: int, the number of accounts deleted
+        """
+        self.detach()
+
+        deleted = set()
+        segments = {}
+        sales_reps = {}
+        stack = [self]
+        while stack:
+            account = stack.pop()
+            deleted.add(id(account))
+            stack.extend(account._children.values())
+
+            for segment in account._market_segments:
+                segment._count(account, -1)
+                segments[id(segment)] = segment
+            sales_rep = account._sales_rep
+            if isinstance(sales_rep, SalesRep):
+                sales_reps[id(sales_rep)] = sales_rep
+
+            account._market_segments = []
+            account._sales_rep = None
+            account._children = {}
+            account._parent_ref = None
+            account._is_child = False
+            account._hash = None
+
+        for segment in segments.values():
+            segment._accounts[:] = [account for account in segment._accounts
+                                    if id(account) not in deleted]
+        for sales_rep in sales_reps.values():
+            sales_rep.get_accounts()[:] = [
+                account for account in sales_rep.get_accounts()
+                if id(account) not in deleted]
+        return len(deleted)
+
+    def _count_as_child(self, delta):
+        """
+        tell this account's market segments it has become a child account
+        (1) or a root account (-1)
+        :param delta: int
+        :return: None
+        """
+        for segment in self._market_segments:
+            segment._child_count += delta
+
+    @classmethod
+    def from_tree(cls, spec, market_segments=None):
+        """
+        build a whole hierarchy of accounts in one pass from a description.
+        The result is the same as calling the Account and ChildAccount
+        constructors for each entry (children inherit the sales rep and
+        market segments of their parent when they don't have their own), but
+        without each child copying and registering its segments one by one
+        through add_account.
+
+        The description is either nested:
+            {"name": "GE", "sales_rep": "Daniel Testperson",
+             "market_segments": ["Manufacturing", "R&D"],
+             "children": [{"name": "Jet Engines", "children": [...]}]}
+        (or a list of those for several root accounts), or a flat list where
+        every entry names its parent (None or missing for root accounts):
+            [{"name": "GE", "sales_rep": "Daniel Testperson"},
+             {"name": "Jet Engines", "parent": "GE"}]
+
+        Market segments can be given as MarketSegment objects or as names.
+        Names are looked up in market_segments and then among the existing
+        MarketSegments (see check_for_existing_market_segment). A new
+        MarketSegment is only created for a name that isn't found anywhere,
+        once the whole hierarchy is known to be fine.
+
+        Raises ValueError for a flat list with a duplicate account name, an
+        unknown parent or entries that can't be reached from a root account
+        (parent loops), and (like the constructors) if an account would be
+        added to a market segment that already has an account with the same
+        name. The market segments are put back the way they were when that
+        happens, so nothing is left behind.
+
+        :param spec: dict or List[dict]
+        :param market_segments: List[MarketSegment] used to look up names
+        :return: Account for a single nested dict, otherwise List[Account]
+                 with the root accounts
+        """
+        segments_by_name = {segment.name: segment
+                            for segment in market_segments or []}
+        # existing segments the new accounts were added to, along with how
+        # many accounts they had before, so they can be checked and put back
+        touched = {}
+        # the new accounts of each segment that doesn't exist yet, until
+        # then the accounts hold the segment's name in its place
+        pending = {}
+
+        flat = not isinstance(spec, dict) and \
+            any("parent" in entry for entry in spec)
+        if flat:
+            roots, children_of = _index_flat_spec(spec)
+        elif isinstance(spec, dict):
+            roots = [spec]
+        else:
+            roots = spec
+
+        def get_children(entry):
+            if flat:
+                return children_of.get(entry["name"], [])
+            return entry.get("children", [])
+
+        def resolve(segment):
+            if isinstance(segment, MarketSegment):
+                return segment
+            if segment not in segments_by_name:
+                segments_by_name[segment] = _find_market_segment(segment)
+            # a name without a segment stays as it is for now
+            return segments_by_name[segment] or segment
+
+        def add_to_segment(segment, account):
+            if isinstance(segment, MarketSegment):
+                if id(segment) not in touched:
+                    touched[id(segment)] = (segment,
+                                            len(segment.get_accounts()))
+                segment.get_accounts().append(account)
+            else:
+                pending.setdefault(segment, []).append(account)
+
+        accounts = []
+        built = 0
+        try:
+            # one iterator over the entries still to be built per level of
+            # the hierarchy, parents are always built before their children
+            stack = [(iter(roots), None)]
+            while stack:
+                entries, parent = stack[-1]
+                entry = next(entries, None)
+                if entry is None:
+                    stack.pop()
+                    continue
+
+                account_cls = cls if parent is None else ChildAccount
+                account = account_cls.__new__(account_cls)
+                account._parent_ref = None if parent is None else \
+                    weakref.ref(parent)
+                account._is_child = parent is not None
+                account._hash = None
+                account._name = entry["name"]
+                account._sales_rep = entry.get("sales_rep")
+                account._children = {}
+                segments = entry.get("market_segments")
+                if parent is not None:
+                    if not account._sales_rep:
+                        account._sales_rep = parent._sales_rep
+                    if not segments:
+                        segments = parent._market_segments
+                # copying the list (rather than building it up) keeps it
+                # exactly as big as the constructors' copies
+                account._market_segments = list(segments or [])
+                for index, segment in enumerate(account._market_segments):
+                    if not isinstance(segment, MarketSegment):
+                        segment = resolve(segment)
+                        account._market_segments[index] = segment
+                    add_to_segment(segment, account)
+
+                built += 1
+                if parent is None:
+                    accounts.append(account)
+                else:
+                    parent._children[id(account)] = account
+                stack.append((iter(get_children(entry)), account))
+
+            if flat and built != len(spec):
+                # entries whose parents form a loop never hang off a root
+                reached = {id(entry) for entry in _reachable(roots,
+                                                            get_children)}
+                raise ValueError("accounts not connected to a root account: "
+                                 "{}".format(", ".join(
+                                     entry["name"] for entry in spec
+                                     if id(entry) not in reached)))
+
+            # account names have to be unique within a segment, checked one
+            # segment at a time so only one set of names exists at once
+            for segment, _ in touched.values():
+                _check_unique_names(segment.get_accounts(), segment.name)
+            for name, segment_accounts in pending.items():
+                _check_unique_names(segment_accounts, name)
+        except Exception:
+            for segment, size in touched.values():
+                del segment.get_accounts()[size:]
+            raise
+
+        # everything is fine, count the new accounts and create the
+        # segments that didn't exist yet
+        for segment, size in touched.values():
+            for account in itertools.islice(segment.get_accounts(), size,
+                                            None):
+                segment._count(account, 1)
+        for name, segment_accounts in pending.items():
+            segment = MarketSegment(name)
+            segment._accounts = segment_accounts
+            for account in segment_accounts:
+                account._market_segments[
+                    account._market_segments.index(name)] = segment
+                segment._count(account, 1)
+
+        if isinstance(spec, dict):
+            return accounts[0]
+        return accounts
 
 
 # +---------------------------------------------------------------------------+
@@ -349,30 +822,21 @@ class ChildAccount(Account):
         :param sales_rep: SalesRep
         :param market_segments: List[MarketSegments]
         """
-        super().__init__(name, sales_rep, market_segments)
-        self.name = name
-        self._children = []
         if not sales_rep:
             # inherit the parents sales rep since none was given
-            self._sales_rep = parent.get_sales_rep()
-        else:
-            self._sales_rep = sales_rep
-        if market_segments:
-            # add market segments to this account and tell those market
-            # segments this account is a member
-            self._market_segments = market_segments
-            for market_segment in self._market_segments:
-                market_segment.add_account(self, add_ms_to_account=False)
-        else:
+            sales_rep = parent.get_sales_rep()
+        if not market_segments:
             # make a copy of the parents market segments (so the parents
-            # market segments don't change with this child) and add the
-            # segments then inform the segments to add this account
-            self._market_segments = copy.copy(parent.get_market_segments())
-            for market_segment in self._market_segments:
-                market_segment.add_account(self, add_ms_to_account=False)
+            # market segments don't change with this child)
+            market_segments = copy.copy(parent.get_market_segments())
+        # remember the parent so changes to this account reach the parent's
+        # content hash and the market segments count this as a child account
+        self._parent_ref = weakref.ref(parent)
+        self._is_child = True
+        # Account.__init__ adds the account to each of the market segments
+        super().__init__(name, sales_rep, market_segments)
 
-        # the parent is the only one maintaining this association, so inform
-        # the parent that they are, in fact, a parent
+        # inform the parent that they are, in fact, a parent
         parent.add_child(self)
 
 
@@ -441,6 +905,91 @@ def print_account(account):
     print(f'{account.name} ({markets_output[:-2]}): {account.get_sales_rep()}')
 
 
+def _find_market_segment(name):
+    """
+    look for an existing MarketSegment with the given name in the global
+    scope, where check_for_existing_market_segment keeps them
+    :param name: string
+    :return: MarketSegment or None
+    """
+    for value in list(globals().values()):
+        if isinstance(value, MarketSegment) and value.name == name:
+            return value
+    return None
+
+
+def _check_unique_names(accounts, segment_name):
+    """
+    raise ValueError if two of the accounts of a segment share a name
+    :param accounts: List[Account]
+    :param segment_name: string
+    :return: None
+    """
+    names = set()
+    for account in accounts:
+        if account.name in names:
+            raise ValueError("{} already associated to {}"
+                             .format(account.name, segment_name))
+        names.add(account.name)
+
+
+def _reachable(roots, get_children):
+    """
+    every entry of an account description that can be reached from the
+    root entries (see Account.from_tree)
+    :param roots: List[dict]
+    :param get_children: function returning the child entries of an entry
+    :return: generator of dict
+    """
+    stack = list(roots)
+    while stack:
+        entry = stack.pop()
+        yield entry
+        stack.extend(get_children(entry))
+
+
+def _update_count(counts, key, delta):
+    """
+    add delta to counts[key], dropping the key once it reaches zero so the
+    number of keys is the number of distinct things being counted
+    :param counts: dict
+    :param key: hashable
+    :param delta: int
+    :return: None
+    """
+    count = counts.get(key, 0) + delta
+    if count:
+        counts[key] = count
+    else:
+        del counts[key]
+
+
+def _index_flat_spec(entries):
+    """
+    split a flat account description (see Account.from_tree) into its root
+    entries and the child entries of every account name
+    :param entries: List[dict]
+    :return: (List[dict], dict mapping parent name to List[dict])
+    """
+    names = set()
+    roots = []
+    children_of = {}
+    for entry in entries:
+        if entry["name"] in names:
+            raise ValueError("{} is described more than once"
+                             .format(entry["name"]))
+        names.add(entry["name"])
+        if entry.get("parent") is None:
+            roots.append(entry)
+        else:
+            children_of.setdefault(entry["parent"], []).append(entry)
+
+    for parent_name in children_of:
+        if parent_name not in names:
+            raise ValueError("unknown parent account {}".format(parent_name))
+    return roots, children_of
+
+
 def check_for_existing_market_segment(segment):
     """
     utility function that checks the global scope for an object that matches
@@ -466,6 +1015,512 @@ def check_for_existing_market_segment(segment):
     globals()[var_name] = segment
 
 
+# +---------------------------------------------------------------------------+
+# |                                                                           |
+# | Rep workload rebalancing. Accounts are spread across SalesReps so that    |
+# | each rep carries roughly the same number of accounts, preferring reps     |
+# | that specialize in one of the account's MarketSegments and keeping        |
+# | ChildAccounts with their parent's rep where possible.                     |
+# |                                                                           |
+# +---------------------------------------------------------------------------+
+
+def _walk_hierarchy(accounts):
+    """
+    yield (account, parent) pairs for the given accounts so that every
+    parent is yielded before its children. The parent is None for accounts
+    whose parent is not part of the given accounts. Accounts listed more
+    than once are only yielded once. This is iterative (breadth first) so
+    deep hierarchies don't hit the recursion limit.
+    :param accounts: List[Account]
+    :return: generator of (Account, Account/None) tuples
+    """
+    wanted = {id(account) for account in accounts}
+    has_parent = set()
+    for account in accounts:
+        for child in account._children.values():
+            if id(child) in wanted:
+                has_parent.add(id(child))
+
+    queue = deque((account, None) for account in accounts
+                  if id(account) not in has_parent)
+    seen = set()
+    while queue:
+        account, parent = queue.popleft()
+        if id(account) in seen:
+            continue
+        seen.add(id(account))
+        yield account, parent
+        for child in account._children.values():
+            if id(child) in wanted:
+                queue.append((child, account))
+
+
+def plan_rebalance(accounts, sales_reps):
+    """
+    work out a balanced rep for every account without changing anything.
+
+    The aim is for every rep to end up with at most ceil(n / k) accounts
+    (the target) for n accounts and k reps. To avoid needless churn an
+    account stays with its current rep, and a ChildAccount goes to its
+    parent's rep, as long as that rep is eligible, has room and is still
+    under the target. Only the remaining accounts go to the least loaded
+    eligible rep.
+
+    A rep is eligible for an account if it's a generalist, the account has
+    no segments, or it specializes in one of the account's segments. The
+    least loaded rep is found with min-heaps keyed on load, one per
+    MarketSegment reps specialize in plus one of every rep. Heap entries
+    are never updated in place, when a rep takes an account a new entry
+    with the new load is pushed into each of its heaps and stale entries
+    are dropped when they reach the top. A heap is compacted once stale
+    entries outnumber its reps, so heaps never hold more than twice as
+    many entries as reps. That makes the plan O(n s log k) time and
+    O(n + k s) memory, where s is the number of specialties a rep has.
+
+    Raises ValueError if the reps don't have enough capacity between them
+    to take every account.
+
+    :param accounts: List[Account]
+    :param sales_reps: List[SalesRep]
+    :return: List[(Account, SalesRep)] in hierarchy order
+    """
+    order = list(_walk_hierarchy(accounts))
+    if not order:
+        return []
+    if not sales_reps:
+        raise ValueError("no sales reps to assign accounts to")
+    target = -(-len(order) // len(sales_reps))
+
+    loads = {id(rep): 0 for rep in sales_reps}
+    general_heap = []
+    segment_heaps = {}
+    # the number of reps in each heap, used to decide when to compact it
+    members = {id(general_heap): len(sales_reps)}
+    # the index is a tie breaker so reps themselves never get compared and
+    # equally loaded reps are picked in the order they were given
+    rep_heaps = []
+    rep_specialties = []
+    for index, rep in enumerate(sales_reps):
+        heaps = [general_heap]
+        for segment in rep.get_market_segments():
+            heap = segment_heaps.setdefault(id(segment), [])
+            members[id(heap)] = members.get(id(heap), 0) + 1
+            heaps.append(heap)
+        rep_heaps.append(heaps)
+        rep_specialties.append({id(segment)
+                                for segment in rep.get_market_segments()})
+        if rep.capacity is None or rep.capacity > 0:
+            for heap in heaps:
+                heapq.heappush(heap, (0, index, rep))
+    rep_index = {id(rep): index for index, rep in enumerate(sales_reps)}
+
+    def has_room(rep):
+        return rep.capacity is None or loads[id(rep)] < rep.capacity
+
+    def is_current(entry):
+        return entry[0] == loads[id(entry[2])]
+
+    def peek(heap):
+        # drop stale entries (the rep's load has changed since the push)
+        while heap and not is_current(heap[0]):
+            heapq.heappop(heap)
+        return heap[0] if heap else None
+
+    def take(rep):
+        index = rep_index[id(rep)]
+        loads[id(rep)] += 1
+        if not has_room(rep):
+            return
+        for heap in rep_heaps[index]:
+            heapq.heappush(heap, (loads[id(rep)], index, rep))
+            if len(heap) > 2 * members[id(heap)]:
+                heap[:] = [entry for entry in heap if is_current(entry)]
+                heapq.heapify(heap)
+
+    def can_keep(rep, segment_ids):
+        # reps outside this rebalance can't keep accounts
+        if rep is None or id(rep) not in rep_index:
+            return False
+        specialties = rep_specialties[rep_index[id(rep)]]
+        return has_room(rep) and loads[id(rep)] < target and \
+            (not specialties or not segment_ids or specialties & segment_ids)
+
+    planned = {}
+    plan = []
+    for account, parent in order:
+        segment_ids = {id(segment)
+                       for segment in account.get_market_segments()}
+
+        # keep the account with its current rep, or a child with its
+        # parent's rep, while that doesn't get in the way of the balance
+        rep = account.get_sales_rep()
+        if not can_keep(rep, segment_ids):
+            rep = planned[id(parent)] if parent is not None else None
+            if not can_keep(rep, segment_ids):
+                rep = None
+
+        if rep is None:
+            # least loaded specialist in any of the account's segments
+            tops = [peek(segment_heaps[segment_id])
+                    for segment_id in segment_ids
+                    if segment_id in segment_heaps]
+            tops = [top for top in tops if top is not None]
+            if not tops:
+                # no specialist has room, fall back to any rep
+                top = peek(general_heap)
+                if top is None:
+                    raise ValueError("not enough sales rep capacity to "
+                                     "assign {}".format(account.name))
+                tops = [top]
+            rep = min(tops)[2]
+
+        take(rep)
+        planned[id(account)] = rep
+        plan.append((account, rep))
+    return plan
+
+
+def bulk_reassign_accounts(assignments):
+    """
+    apply many account to rep assignments at once. Removing accounts from
+    a rep one at a time is O(n) per account, so instead every rep that
+    loses accounts has its account list filtered once at the end.
+    Sales reps that aren't SalesRep instances (i.e. plain names) don't track
+    their accounts so only the account side is updated for those.
+    :param assignments: iterable of (Account, SalesRep) tuples
+    :return: int, the number of accounts that changed rep
+    """
+    moved = 0
+    losing_reps = {}
+    removed = set()
+    for account, sales_rep in assignments:
+        old_rep = account.get_sales_rep()
+        if old_rep is sales_rep:
+            continue
+        moved += 1
+        if isinstance(old_rep, SalesRep):
+            losing_reps[id(old_rep)] = old_rep
+            removed.add((id(old_rep), id(account)))
+        account.set_sales_rep(sales_rep)
+        if isinstance(sales_rep, SalesRep):
+            sales_rep.get_accounts().append(account)
+
+    for rep_id, rep in losing_reps.items():
+        rep.get_accounts()[:] = [account for account in rep.get_accounts()
+                                 if (rep_id, id(account)) not in removed]
+    return moved
+
+
+def rebalance_accounts(accounts, sales_reps):
+    """
+    spread the accounts evenly across the sales reps (see plan_rebalance)
+    and apply the result in bulk
+    :param accounts: List[Account]
+    :param sales_reps: List[SalesRep]
+    :return: int, the number of accounts that changed rep
+    """
+    return bulk_reassign_accounts(plan_rebalance(accounts, sales_reps))
+
+
+# +---------------------------------------------------------------------------+
+# |                                                                           |
+# | Streaming export of account hierarchies. The same data print_tree shows   |
+# | (name, SalesRep, MarketSegments and children) written as nested JSON or   |
+# | as flat NDJSON with parent ids. The hierarchy is walked iteratively and   |
+# | the output is written to the file object in chunks, so memory use only    |
+# | depends on the depth of the hierarchy, never on the number of accounts.   |
+# |                                                                           |
+# +---------------------------------------------------------------------------+
+
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+
+def _account_fields(account):
+    """
+    the exportable fields of a single account, children excluded
+    :param account: Account
+    :return: dict
+    """
+    sales_rep = account.get_sales_rep()
+    return {"name": account.name,
+            "rep": None if sales_rep is None else str(sales_rep),
+            "segments": [segment.name
+                         for segment in account.get_market_segments()]}
+
+
+def _write_chunks(pieces, fp, chunk_size):
+    """
+    join the pieces of output together and write them to fp roughly
+    chunk_size characters at a time
+    :param pieces: iterable of strings
+    :param fp: file like object opened for writing text
+    :param chunk_size: int
+    :return: None
+    """
+    buffer = []
+    size = 0
+    for piece in pieces:
+        buffer.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            fp.write("".join(buffer))
+            buffer = []
+            size = 0
+    if buffer:
+        fp.write("".join(buffer))
+
+
+def _json_tree_pieces(accounts):
+    """
+    generate the nested JSON for the accounts piece by piece. Instead of
+    recursing, a stack holds an iterator over the children still to be
+    written at each level of the hierarchy.
+    :param accounts: iterable of Account
+    :return: generator of strings
+    """
+    yield "["
+    stack = [iter(accounts)]
+    first = [True]
+    while stack:
+        account = next(stack[-1], None)
+        if account is None:
+            # every child at this level is written, close the children
+            # list and (unless this was the top level) the parent object
+            stack.pop()
+            first.pop()
+            yield "]}" if stack else "]"
+            continue
+
+        if not first[-1]:
+            yield ", "
+        first[-1] = False
+        fields = _account_fields(account)
+        yield ('{{"name": {name}, "rep": {rep}, "segments": {segments}, '
+               '"children": ['.format(
+                   name=json.dumps(fields["name"]),
+                   rep=json.dumps(fields["rep"]),
+                   segments=json.dumps(fields["segments"])))
+        stack.append(iter(account._children.values()))
+        first.append(True)
+
+
+def _ndjson_tree_pieces(accounts):
+    """
+    generate one JSON line per account, parents always come before their
+    children. Accounts are numbered in the order they're written and each
+    line refers to its parent by that number (null for the root accounts).
+    Like _json_tree_pieces the stack only holds one iterator per level of
+    the hierarchy, along with the id of the account whose children it
+    goes through.
+    :param accounts: iterable of Account
+    :return: generator of strings
+    """
+    next_id = 0
+    stack = [(iter(accounts), None)]
+    while stack:
+        children, parent_id = stack[-1]
+        account = next(children, None)
+        if account is None:
+            stack.pop()
+            continue
+
+        record = {"id": next_id, "parent_id": parent_id}
+        record.update(_account_fields(account))
+        yield json.dumps(record) + "\n"
+        stack.append((iter(account._children.values()), next_id))
+        next_id += 1
+
+
+def write_tree_json(accounts, fp, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    write the hierarchy under the accounts to fp as a JSON list of nested
+    objects, e.g.
+    [{"name": "GE", "rep": "Daniel Testperson",
+      "segments": ["Manufacturing", "R&D"],
+      "children": [{"name": "Jet Engines", ...}]}]
+    :param accounts: Account or iterable of Account (the roots of the
+                     forest, a generator works too)
+    :param fp: file like object opened for writing text
+    :param chunk_size: int, roughly how many characters to write at once
+    :return: None
+    """
+    if isinstance(accounts, Account):
+        accounts = [accounts]
+    _write_chunks(_json_tree_pieces(accounts), fp, chunk_size)
+
+
+def write_tree_ndjson(accounts, fp, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    write the hierarchy under the accounts to fp as newline delimited JSON,
+    one flat object per account with "id" and "parent_id" keys, e.g.
+    {"id": 0, "parent_id": null, "name": "GE", ...}
+    {"id": 1, "parent_id": 0, "name": "Jet Engines", ...}
+    :param accounts: Account or iterable of Account (the roots of the
+                     forest, a generator works too)
+    :param fp: file like object opened for writing text
+    :param chunk_size: int, roughly how many characters to write at once
+    :return: None
+    """
+    if isinstance(accounts, Account):
+        accounts = [accounts]
+    _write_chunks(_ndjson_tree_pieces(accounts), fp, chunk_size)
+
+
+# +---------------------------------------------------------------------------+
+# |                                                                           |
+# | Hierarchy diff. Two forests of accounts (e.g. the in-memory accounts and  |
+# | a nightly CRM snapshot) are compared using the Merkle style content       |
+# | hashes from Account.get_content_hash, so identical subtrees are skipped   |
+# | with a single comparison. Accounts are matched between the two forests    |
+# | by name among their siblings, the same way MarketSegments use the name    |
+# | to decide whether two accounts are the same (see Q2-Bonus). Siblings      |
+# | that share a name are matched in the order they appear.                   |
+# |                                                                           |
+# +---------------------------------------------------------------------------+
+
+HierarchyDiff = namedtuple("HierarchyDiff", ["added", "removed", "changed"])
+
+
+def _own_content(account):
+    """
+    the part of an account's content that doesn't depend on its children
+    :param account: Account
+    :return: tuple
+    """
+    sales_rep = account.get_sales_rep()
+    return (None if sales_rep is None else str(sales_rep),
+            sorted(segment.name for segment in account.get_market_segments()))
+
+
+def _subtree(account):
+    """
+    every account in the subtree under (and including) account, parents
+    before children
+    :param account: Account
+    :return: List[Account]
+    """
+    accounts = [account]
+    stack = [iter(account._children.values())]
+    while stack:
+        child = next(stack[-1], None)
+        if child is None:
+            stack.pop()
+            continue
+        accounts.append(child)
+        stack.append(iter(child._children.values()))
+    return accounts
+
+
+def _key_siblings(accounts):
+    """
+    key sibling accounts by their name and how many siblings before them
+    have the same name, so siblings sharing a name don't replace each other
+    :param accounts: List[Account]
+    :return: dict mapping (string, int) to Account
+    """
+    keyed = {}
+    seen = {}
+    for account in accounts:
+        position = seen.get(account.name, 0)
+        seen[account.name] = position + 1
+        keyed[(account.name, position)] = account
+    return keyed
+
+
+def diff_trees(old_accounts, new_accounts):
+    """
+    find the accounts that were added, removed or changed between two
+    forests of accounts. Every account in an added or removed subtree is
+    reported, and an account counts as changed if its sales rep or market
+    segments are different (changes further down are reported on their
+    own).
+    :param old_accounts: Account or List[Account] (roots of the old forest)
+    :param new_accounts: Account or List[Account] (roots of the new forest)
+    :return: HierarchyDiff(added=List[Account], removed=List[Account],
+                           changed=List[(Account, Account)]) where changed
+             holds (old account, new account) pairs
+    """
+    if isinstance(old_accounts, Account):
+        old_accounts = [old_accounts]
+    if isinstance(new_accounts, Account):
+        new_accounts = [new_accounts]
+
+    diff = HierarchyDiff(added=[], removed=[], changed=[])
+    stack = [(old_accounts, new_accounts)]
+    while stack:
+        old_siblings, new_siblings = stack.pop()
+        old_by_key = _key_siblings(old_siblings)
+        new_by_key = _key_siblings(new_siblings)
+
+        for key, old in old_by_key.items():
+            new = new_by_key.get(key)
+            if new is None:
+                diff.removed.extend(_subtree(old))
+            elif old.get_content_hash() != new.get_content_hash():
+                # something in this subtree is different, find out whether
+                # it's this account and keep looking further down
+                if _own_content(old) != _own_content(new):
+                    diff.changed.append((old, new))
+                stack.append((old._children.values(), new._children.values()))
+        for key, new in new_by_key.items():
+            if key not in old_by_key:
+                diff.added.extend(_subtree(new))
+    return diff
+
+
+# +---------------------------------------------------------------------------+
+# |                                                                           |
+# | Rollup counters. MarketSegments keep per-rep and root/child account       |
+# | counts (MarketSegment.get_rollup) and SalesReps keep per-segment account  |
+# | counts (SalesRep.get_segment_counts) up to date on every change, so the   |
+# | overview doesn't need to go through get_accounts(). check_rollups works   |
+# | the same numbers out from scratch to make sure they agree.                |
+# |                                                                           |
+# +---------------------------------------------------------------------------+
+
+def check_rollups(market_segments, sales_reps=None):
+    """
+    recompute every rollup counter by going through the accounts of each
+    market segment and compare with the counters being kept up to date.
+    The sales reps' counts are only complete if every segment any of their
+    accounts is in was given.
+    :param market_segments: List[MarketSegment]
+    :param sales_reps: List[SalesRep]
+    :return: List[string] describing each mismatch, empty if they all agree
+    """
+    problems = []
+    segment_counts = {id(rep): {} for rep in sales_reps or []}
+    for segment in market_segments:
+        rep_counts = {}
+        child_count = 0
+        for account in segment.get_accounts():
+            if account._is_child:
+                child_count += 1
+            sales_rep = account.get_sales_rep()
+            if sales_rep is None:
+                continue
+            _update_count(rep_counts, sales_rep, 1)
+            if id(sales_rep) in segment_counts:
+                _update_count(segment_counts[id(sales_rep)], segment, 1)
+
+        expected = {"accounts": len(segment.get_accounts()),
+                    "sales_reps": len(rep_counts),
+                    "root_accounts": len(segment.get_accounts()) - child_count,
+                    "child_accounts": child_count}
+        if segment.get_rollup() != expected:
+            problems.append("{} rollup is {}, expected {}".format(
+                segment.name, segment.get_rollup(), expected))
+        if segment._rep_counts != rep_counts:
+            problems.append("{} rep counts are {}, expected {}".format(
+                segment.name, segment._rep_counts, rep_counts))
+
+    for rep in sales_reps or []:
+        if rep.get_segment_counts() != segment_counts[id(rep)]:
+            problems.append("{} segment counts are {}, expected {}".format(
+                rep, rep.get_segment_counts(), segment_counts[id(rep)]))
+    return problems
+
+
 # +---------------------------------------------------------------------------+
 # |                                                                           |
 # | Q5-1. Devise a SQL schema that could be used to persist the data          |
@@ -105,3 +105,439 @@ def test_accounts(setup_pct):
     assert test_account in test_ms_2.get_accounts()
     assert test_ms_3 in test_account.get_market_segments()
     assert test_account in test_ms_3.get_accounts()
+
+
+def test_rebalance_accounts(setup_pct):
+
+    pct = setup_pct
+    tech_ms = pct.MarketSegment(name="Rebalance Tech")
+    retail_ms = pct.MarketSegment(name="Rebalance Retail")
+    tech_rep = pct.SalesRep("Tech", "Rep", market_segments=[tech_ms])
+    retail_rep = pct.SalesRep("Retail", "Rep", market_segments=[retail_ms])
+    general_rep = pct.SalesRep("General", "Rep", capacity=1)
+
+    tech_1 = pct.Account(name="Tech 1", market_segments=[tech_ms])
+    tech_2 = pct.Account(name="Tech 2", market_segments=[tech_ms])
+    retail = pct.Account(name="Retail", market_segments=[retail_ms])
+    other_1 = pct.Account(name="Other 1")
+    other_2 = pct.Account(name="Other 2")
+    # retail_rep can't keep a tech account, it has to move
+    tech_1.set_sales_rep(retail_rep)
+    retail_rep.get_accounts().append(tech_1)
+
+    # children stay with their parent's rep where possible
+    tech_child = pct.ChildAccount(name="Tech Child", parent=tech_2)
+
+    accounts = [tech_child, tech_1, tech_2, retail, other_1, other_2]
+    moved = pct.rebalance_accounts(accounts,
+                                   [tech_rep, retail_rep, general_rep])
+    assert moved == 6
+
+    # specialists get the accounts in their segments
+    assert tech_1.get_sales_rep() is tech_rep
+    assert tech_2.get_sales_rep() is tech_rep
+    assert tech_child.get_sales_rep() is tech_rep
+    assert retail.get_sales_rep() is retail_rep
+
+    # everything else goes to the least loaded rep with room, capacity is
+    # respected
+    assert other_1.get_sales_rep() is general_rep
+    assert other_2.get_sales_rep() is retail_rep
+    assert general_rep.get_accounts() == [other_1]
+    assert retail_rep.get_accounts() == [retail, other_2]
+    assert len(tech_rep.get_accounts()) == 3
+
+    # running it again is stable
+    assert pct.rebalance_accounts(accounts,
+                                  [tech_rep, retail_rep, general_rep]) == 0
+
+    # not enough capacity for everyone
+    with pytest.raises(ValueError):
+        pct.rebalance_accounts(accounts,
+                               [pct.SalesRep("Small", "Rep", capacity=2)])
+    assert tech_1.get_sales_rep() is tech_rep
+
+    # a child without segments stays with its parent's specialist rep, and
+    # accounts listed twice are only assigned once
+    parent = pct.Account(name="Specialist Parent", market_segments=[tech_ms])
+    plain_child = pct.ChildAccount(name="Plain Child", parent=parent)
+    plain_child.remove_from_market_segment(tech_ms)
+    specialist = pct.SalesRep("Spec", "Rep", market_segments=[tech_ms],
+                              capacity=2)
+    generalist = pct.SalesRep("Gen", "Rep")
+    generalist_account = pct.Account(name="Generalist Account")
+    generalist.add_account(generalist_account)
+    assert pct.rebalance_accounts([parent, generalist_account, plain_child,
+                                   parent],
+                                  [specialist, generalist]) == 2
+    assert generalist_account.get_sales_rep() is generalist
+    assert plain_child.get_sales_rep() is specialist
+    assert specialist.get_accounts() == [parent, plain_child]
+
+    # accounts keep their current rep while the reps are balanced, so a
+    # new account doesn't reshuffle everyone else
+    reps = [pct.SalesRep("Stable", str(i)) for i in range(3)]
+    accounts = [pct.Account(name="Stable {}".format(i)) for i in range(9)]
+    pct.rebalance_accounts(accounts, reps)
+    assert [len(rep.get_accounts()) for rep in reps] == [3, 3, 3]
+    accounts.insert(0, pct.Account(name="Stable New"))
+    assert pct.rebalance_accounts(accounts, reps) == 1
+    assert sorted(len(rep.get_accounts()) for rep in reps) == [3, 3, 4]
+
+    # children only stay with their parent's rep while that keeps the reps
+    # balanced, so a big hierarchy is still spread out
+    reps = [pct.SalesRep("Big", str(i)) for i in range(3)]
+    root = pct.Account(name="Big Root")
+    accounts = [root] + [pct.ChildAccount(name="Big {}".format(i),
+                                          parent=root)
+                         for i in range(99)]
+    assert pct.rebalance_accounts(accounts, reps) == 100
+    assert [len(rep.get_accounts()) for rep in reps] == [34, 33, 33]
+    assert all(child.get_sales_rep() is reps[0]
+               for child in accounts[1:34])
+
+
+def test_write_tree_json(setup_pct):
+
+    import io
+    import json
+
+    pct = setup_pct
+    test_ms = pct.MarketSegment(name="Export Segment")
+    root = pct.Account(name="Root", sales_rep="Daffy Duck",
+                       market_segments=[test_ms])
+    child = pct.ChildAccount(name="Child", parent=root)
+    pct.ChildAccount(name="Grandchild", parent=child, sales_rep="Bugs Bunny")
+    other = pct.Account(name="Other")
+
+    # nested JSON, a tiny chunk size makes sure output is split up
+    out = io.StringIO()
+    pct.write_tree_json([root, other], out, chunk_size=8)
+    assert json.loads(out.getvalue()) == [
+        {"name": "Root", "rep": "Daffy Duck",
+         "segments": ["Export Segment"],
+         "children": [
+             {"name": "Child", "rep": "Daffy Duck",
+              "segments": ["Export Segment"],
+              "children": [
+                  {"name": "Grandchild", "rep": "Bugs Bunny",
+                   "segments": ["Export Segment"],
+                   "children": []}]}]},
+        {"name": "Other", "rep": None, "segments": [], "children": []}]
+
+    # flat NDJSON with parent ids
+    out = io.StringIO()
+    pct.write_tree_ndjson(root, out)
+    records = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert [(record["id"], record["parent_id"], record["name"])
+            for record in records] == [(0, None, "Root"),
+                                       (1, 0, "Child"),
+                                       (2, 1, "Grandchild")]
+    assert records[2]["rep"] == "Bugs Bunny"
+
+    # the roots can be streamed from a generator
+    out = io.StringIO()
+    pct.write_tree_ndjson((account for account in [other, root]), out)
+    records = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert [(record["id"], record["parent_id"], record["name"])
+            for record in records] == [(0, None, "Other"),
+                                       (1, None, "Root"),
+                                       (2, 1, "Child"),
+                                       (3, 2, "Grandchild")]
+
+
+def test_content_hash_and_diff(setup_pct):
+
+    pct = setup_pct
+    test_ms_2 = pct.MarketSegment(name="Hash Segment 2")
+
+    # segments only allow one account per name, so each tree needs its own
+    # (equally named) segment, just like a snapshot loaded from elsewhere
+    def build():
+        root = pct.Account(name="Root", sales_rep="Daffy Duck",
+                           market_segments=[
+                               pct.MarketSegment(name="Hash Segment")])
+        child = pct.ChildAccount(name="Child", parent=root)
+        pct.ChildAccount(name="Grandchild", parent=child)
+        pct.ChildAccount(name="Sibling", parent=root)
+        return root
+
+    old = build()
+    new = build()
+    assert old.get_content_hash() == new.get_content_hash()
+    assert pct.diff_trees(old, new) == ([], [], [])
+
+    # a change deep down the tree reaches every ancestor's hash
+    root_hash = new.get_content_hash()
+    child, sibling = new.get_children()
+    sibling_hash = sibling.get_content_hash()
+    grandchild = child.get_children()[0]
+    grandchild.add_to_market_segment(test_ms_2)
+    assert new.get_content_hash() != root_hash
+    assert sibling.get_content_hash() == sibling_hash
+
+    # undoing the change gives the original hash back
+    grandchild.remove_from_market_segment(test_ms_2)
+    assert new.get_content_hash() == root_hash
+
+    grandchild.set_sales_rep("Bugs Bunny")
+    new_child = pct.ChildAccount(name="New Child", parent=sibling)
+    pct.ChildAccount(name="New Grandchild", parent=new_child)
+    removed = pct.ChildAccount(name="Removed", parent=old)
+
+    diff = pct.diff_trees(old, new)
+    assert [account.name for account in diff.added] == ["New Child",
+                                                        "New Grandchild"]
+    assert diff.removed == [removed]
+    assert diff.changed == [(old.get_children()[0].get_children()[0],
+                             grandchild)]
+
+    # siblings can share a name, every one of them is still compared
+    old = pct.Account(name="Duplicates")
+    pct.ChildAccount(name="Same", parent=old)
+    removed = pct.ChildAccount(name="Same", parent=old)
+    new = pct.Account(name="Duplicates")
+    pct.ChildAccount(name="Same", parent=new)
+    assert pct.diff_trees(old, new) == ([], [removed], [])
+    assert pct.diff_trees(new, old) == ([removed], [], [])
+
+
+def test_from_tree(setup_pct):
+
+    pct = setup_pct
+
+    # segment names are looked up among the existing segments, and missing
+    # segments are created
+    aero_ms = pct.MarketSegment(name="Tree Aerospace")
+    account = pct.Account.from_tree(
+        {"name": "GE", "sales_rep": "Daniel Testperson",
+         "market_segments": ["Tree Manufacturing"],
+         "children": [{"name": "Jet Engines",
+                       "children": [{"name": "DoD Contracts",
+                                     "sales_rep": "William Testperson",
+                                     "market_segments": ["Tree Aerospace"]}]},
+                      {"name": "Appliances"}]})
+    manufacturing_ms = pct.Tree_Manufacturing_ms
+    jet_engines, appliances = account.get_children()
+    dod_contracts = jet_engines.get_children()[0]
+    assert type(account) is pct.Account
+    assert isinstance(dod_contracts, pct.ChildAccount)
+    assert jet_engines.get_market_segments() == [manufacturing_ms]
+    assert manufacturing_ms.get_accounts() == [account, jet_engines,
+                                               appliances]
+    assert aero_ms.get_accounts() == [dod_contracts]
+    assert jet_engines.get_market_segments() is not \
+        account.get_market_segments()
+    assert pct.check_rollups([manufacturing_ms, aero_ms]) == []
+
+    # the constructors build exactly the same hierarchy
+    tree_hash = account.get_content_hash()
+    account.delete_subtree()
+    expected = pct.Account(name="GE", sales_rep="Daniel Testperson",
+                           market_segments=[manufacturing_ms])
+    jet_engines = pct.ChildAccount(name="Jet Engines", parent=expected)
+    pct.ChildAccount(name="DoD Contracts", parent=jet_engines,
+                     sales_rep="William Testperson",
+                     market_segments=[aero_ms])
+    pct.ChildAccount(name="Appliances", parent=expected)
+    assert expected.get_content_hash() == tree_hash
+
+    # naming the segment again uses the same segment
+    other = pct.Account.from_tree({"name": "Other",
+                                   "market_segments": ["Tree Manufacturing"]})
+    assert other.get_market_segments() == [manufacturing_ms]
+    assert manufacturing_ms.get_rollup()["accounts"] == 4
+
+    # a flat description, parents may come after their children and
+    # segment names are looked up in the given segments first
+    defense_ms = pct.MarketSegment(name="Tree Defense")
+    roots = pct.Account.from_tree(
+        [{"name": "Appliances", "parent": "GE"},
+         {"name": "DoD Contracts", "parent": "Jet Engines",
+          "sales_rep": "William Testperson",
+          "market_segments": ["Tree Defense"]},
+         {"name": "GE", "sales_rep": "Daniel Testperson"},
+         {"name": "Jet Engines", "parent": "GE"}],
+        market_segments=[defense_ms])
+    assert [root.name for root in roots] == ["GE"]
+    assert [child.name for child in roots[0].get_children()] == [
+        "Appliances", "Jet Engines"]
+    dod_contracts = roots[0].get_children()[1].get_children()[0]
+    assert dod_contracts.get_sales_rep() == "William Testperson"
+    assert defense_ms.get_accounts() == [dod_contracts]
+
+    with pytest.raises(ValueError):
+        pct.Account.from_tree([{"name": "Orphan", "parent": "Missing"}])
+    # parents that form a loop can't be reached from any root
+    with pytest.raises(ValueError) as val_err:
+        pct.Account.from_tree([{"name": "X", "parent": "Y"},
+                               {"name": "Y", "parent": "X"},
+                               {"name": "Root"}])
+    assert "X, Y" in str(val_err.value)
+    with pytest.raises(ValueError):
+        pct.Account.from_tree([{"name": "Z", "parent": "Z"}])
+
+    # the constructors don't allow two accounts of the same name in a
+    # segment, and neither does from_tree. The segments are left as they
+    # were and no new segments are created when that happens
+    with pytest.raises(ValueError):
+        pct.Account.from_tree({"name": "A",
+                               "market_segments": ["Tree Manufacturing",
+                                                   "Tree Ghost"],
+                               "children": [{"name": "B"}, {"name": "GE"}]})
+    assert [account.name for account in manufacturing_ms.get_accounts()] == [
+        "GE", "Jet Engines", "Appliances", "Other"]
+    assert manufacturing_ms.get_rollup()["accounts"] == 4
+    assert pct.check_rollups([manufacturing_ms]) == []
+    assert not hasattr(pct, "Tree_Ghost_ms")
+
+
+def test_rollups(setup_pct):
+
+    pct = setup_pct
+    test_ms = pct.MarketSegment(name="Rollup Segment")
+    test_ms_2 = pct.MarketSegment(name="Rollup Segment 2")
+    rep_1 = pct.SalesRep("Rollup", "One")
+    rep_2 = pct.SalesRep("Rollup", "Two")
+    segments = [test_ms, test_ms_2]
+    reps = [rep_1, rep_2]
+
+    root = pct.Account(name="Root", sales_rep=rep_1,
+                       market_segments=[test_ms])
+    child = pct.ChildAccount(name="Child", parent=root)
+    assert test_ms.get_rollup() == {"accounts": 2, "sales_reps": 1,
+                                    "root_accounts": 1, "child_accounts": 1}
+    assert rep_1.get_segment_counts() == {test_ms: 2}
+    assert pct.check_rollups(segments, reps) == []
+
+    # rep changes
+    child.set_sales_rep(rep_2)
+    assert test_ms.get_rollup()["sales_reps"] == 2
+    assert rep_1.get_segment_counts() == {test_ms: 1}
+    assert rep_2.get_segment_counts() == {test_ms: 1}
+    assert pct.check_rollups(segments, reps) == []
+
+    # linking and unlinking
+    test_ms_2.add_account(child)
+    root.add_to_market_segment(test_ms_2)
+    assert test_ms_2.get_rollup() == {"accounts": 2, "sales_reps": 2,
+                                      "root_accounts": 1,
+                                      "child_accounts": 1}
+    test_ms.remove_account(child)
+    child.set_market_segments([test_ms, test_ms_2])
+    root.remove_from_market_segment(test_ms)
+    assert test_ms.get_rollup() == {"accounts": 1, "sales_reps": 1,
+                                    "root_accounts": 0, "child_accounts": 1}
+    assert rep_1.get_segment_counts() == {test_ms_2: 1}
+    assert rep_2.get_segment_counts() == {test_ms: 1, test_ms_2: 1}
+    assert pct.check_rollups(segments, reps) == []
+
+    # bulk reassignment and hierarchies built in one pass
+    pct.bulk_reassign_accounts([(root, rep_2), (child, rep_1)])
+    pct.Account.from_tree({"name": "Tree Root", "sales_rep": rep_2,
+                           "market_segments": [test_ms],
+                           "children": [{"name": "Tree Child"}]})
+    assert test_ms.get_rollup() == {"accounts": 3, "sales_reps": 2,
+                                    "root_accounts": 1, "child_accounts": 2}
+    assert pct.check_rollups(segments, reps) == []
+
+    # the check notices counters that have gone out of date
+    test_ms._child_count = 0
+    assert len(pct.check_rollups(segments, reps)) == 1
+
+
+def test_detach_reparent_delete(setup_pct):
+
+    import gc
+    import weakref
+
+    pct = setup_pct
+    test_ms = pct.MarketSegment(name="Subtree Segment")
+    rep = pct.SalesRep("Subtree", "Rep")
+    root = pct.Account(name="Root", sales_rep=rep, market_segments=[test_ms])
+    child = pct.ChildAccount(name="Child", parent=root)
+    grandchild = pct.ChildAccount(name="Grandchild", parent=child)
+    other = pct.ChildAccount(name="Other", parent=root)
+    rep.get_accounts().extend([root, child, grandchild, other])
+    assert grandchild.get_parent() is child
+    assert root.get_parent() is None
+
+    # detaching makes the child a root account, its children come along
+    root_hash = root.get_content_hash()
+    child.detach()
+    assert child.get_parent() is None
+    assert root.get_children() == [other]
+    assert child.get_children() == [grandchild]
+
+    # get_children returns a list of the children, changing it doesn't
+    # change the account
+    root.get_children().append(child)
+    assert root.get_children() == [other]
+    assert root.get_content_hash() != root_hash
+    assert test_ms.get_rollup()["root_accounts"] == 2
+    assert pct.check_rollups([test_ms], [rep]) == []
+
+    # and it can be moved back, or somewhere else
+    child.reparent(root)
+    assert root.get_children() == [other, child]
+    assert root.get_content_hash() != root_hash
+    child.reparent(other)
+    assert other.get_children() == [child]
+    assert root.get_children() == [other]
+    assert pct.check_rollups([test_ms], [rep]) == []
+
+    # an account can't be moved under its own descendants
+    with pytest.raises(ValueError):
+        root.reparent(grandchild)
+
+    # deleting a subtree unlinks every account in it
+    refs = [weakref.ref(child), weakref.ref(grandchild)]
+    assert other.delete_subtree() == 3
+    assert root.get_children() == []
+    assert test_ms.get_accounts() == [root]
+    assert rep.get_accounts() == [root]
+    assert test_ms.get_rollup() == {"accounts": 1, "sales_reps": 1,
+                                    "root_accounts": 1, "child_accounts": 0}
+    assert pct.check_rollups([test_ms], [rep]) == []
+
+    # nothing else holds on to the deleted accounts
+    del child, grandchild, other
+    gc.collect()
+    assert [ref() for ref in refs] == [None, None]
+
+    # parents are only weakly referenced by their children
+    parent = pct.Account(name="Parent")
+    orphan = pct.ChildAccount(name="Orphan", parent=parent)
+    del parent
+    gc.collect()
+    assert orphan.get_parent() is None
+
+    # an account whose parent was garbage collected still counts as a child
+    # account until it's detached, and the counters stay consistent
+    orphan_ms = pct.MarketSegment(name="Orphan Segment")
+    parent = pct.Account(name="Parent")
+    orphan = pct.ChildAccount(name="Orphan", parent=parent,
+                              market_segments=[orphan_ms])
+    del parent
+    gc.collect()
+    assert orphan.get_parent() is None
+    assert pct.check_rollups([orphan_ms]) == []
+    orphan.detach()
+    assert orphan_ms.get_rollup() == {"accounts": 1, "sales_reps": 0,
+                                      "root_accounts": 1,
+                                      "child_accounts": 0}
+    assert pct.check_rollups([orphan_ms]) == []
+    orphan_ms.remove_account(orphan)
+    assert orphan_ms.get_rollup() == {"accounts": 0, "sales_reps": 0,
+                                      "root_accounts": 0,
+                                      "child_accounts": 0}
+
+    # removing it from a segment without detaching it first works too
+    parent = pct.Account(name="Parent")
+    orphan = pct.ChildAccount(name="Orphan", parent=parent,
+                              market_segments=[orphan_ms])
+    del parent
+    gc.collect()
+    orphan_ms.remove_account(orphan)
+    assert orphan_ms.get_rollup()["root_accounts"] == 0
+    assert pct.check_rollups([orphan_ms]) == []